@@ -1,10 +1,17 @@
+import json
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import pandas as pd
+import pyproj
+import shapely
+from shapely.ops import transform as geom_transform
 import geopandas as gpd
 import matplotlib
 matplotlib.use("Agg")  # non-GUI backend
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import contextily as ctx
 
 from flask import (
@@ -17,6 +24,7 @@ from flask import (
     send_from_directory,
 )
 
+from matplotlib.collections import LineCollection
 from matplotlib.lines import Line2D
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
 import matplotlib.font_manager as fm
@@ -94,6 +102,74 @@ def download_and_save(url, filename):
                     f.write(chunk)
     return filepath
 
+# ─────────────────────────────
+# Shared datasets: loaded once at startup
+# ─────────────────────────────
+# The countries file is small (~250 polygons) but re-parsing the Natural Earth
+# zip on every request costs hundreds of ms of Fiona/GDAL work. Load it once
+# into module-level globals and precompute a lowercased SOVEREIGNT column plus
+# an exact-match lookup table so the common path is a dict hit.
+COUNTRIES_FP = download_and_save(DATA_URL + "naturalearth/" + COUNTRIES_FILE, COUNTRIES_FILE)
+
+_COUNTRY_GDF = gpd.read_file(COUNTRIES_FP)
+_COUNTRY_GDF["_sov_lower"] = _COUNTRY_GDF["SOVEREIGNT"].str.lower()
+_COUNTRY_NON_DEP = _COUNTRY_GDF[_COUNTRY_GDF["TYPE"] != "Dependency"]
+# sov_lower -> positional indices into _COUNTRY_NON_DEP (a sovereignty can
+# span several rows)
+_COUNTRY_EXACT = _COUNTRY_NON_DEP.groupby("_sov_lower").indices
+# Fixed-width string array for the substring fallback: np.char.find scans it
+# without rebuilding a pandas StringArray on every request.
+_SOV_LOWER_NP = _COUNTRY_NON_DEP["_sov_lower"].to_numpy(dtype=str)
+
+# The rivers GPKG is the hot-path I/O: `gpd.read_file(..., mask=...)` re-opens
+# the file and walks its SQLite RTree on every request. Instead load the whole
+# dataset once and build an in-memory STRtree; per-request selection then is a
+# single tree query returning integer indices.
+HYDRORIVERS_FP = download_and_save(DATA_URL + "hydrosheds/" + HYDRORIVERS_FILE, HYDRORIVERS_FILE)
+
+# Convert the GPKG to GeoParquet once; subsequent startups read the columnar
+# Parquet file, which is far faster than Fiona's row-by-row GPKG parse.
+_RIVERS_PARQUET_FP = HYDRORIVERS_FP.replace(".gpkg", ".parquet")
+if not os.path.exists(_RIVERS_PARQUET_FP):
+    print("Converting", HYDRORIVERS_FILE, "to GeoParquet (one-time)...")
+    gpd.read_file(HYDRORIVERS_FP).to_parquet(_RIVERS_PARQUET_FP, compression="zstd")
+
+_RIVERS_GDF = gpd.read_parquet(_RIVERS_PARQUET_FP)
+
+# Reproject the full dataset to Web Mercator once; per-request we then only
+# reproject the (single) mainland polygon instead of every intersecting river.
+# The STRtree is built on the 3857 geometries so queries happen in that CRS.
+_RIVERS_3857 = _RIVERS_GDF.to_crs(epsg=3857)
+# Only the 3857 copy is ever used from here on; keeping the source-CRS frame
+# alive would double resident memory for the largest dataset in the process.
+del _RIVERS_GDF
+_RIVERS_TREE = shapely.STRtree(_RIVERS_3857.geometry.values)
+
+# Per-river size metric as a plain NumPy array so the per-request metric
+# lookup is a fancy-index instead of a pandas fillna/astype pipeline.
+# float32 halves the bytes moved by the normalize/digitize passes and is
+# plenty of precision for a relative size classification.
+if "UPLAND_SKM" in _RIVERS_3857.columns:
+    _UPLAND = _RIVERS_3857["UPLAND_SKM"].fillna(0).to_numpy(dtype=np.float32)
+else:
+    _UPLAND = _RIVERS_3857.geometry.length.to_numpy().astype(np.float32)
+
+# ─────────────────────────────
+# Helper: cached CRS transformers
+# ─────────────────────────────
+# pyproj Transformer construction is not free; Natural Earth is always
+# EPSG:4326 so the same (src, dst) pair recurs on every request.
+_TRANSFORMERS = {}
+
+
+def get_transformer(src_crs, dst_crs):
+    key = (str(src_crs), str(dst_crs))
+    tr = _TRANSFORMERS.get(key)
+    if tr is None:
+        tr = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+        _TRANSFORMERS[key] = tr
+    return tr
+
 # ─────────────────────────────
 # Helpers: scale bar + north arrow
 # ─────────────────────────────
@@ -131,55 +207,156 @@ def add_north_arrow(ax, x=0.95, y=0.15, size=0.06):
     )
 
 # ─────────────────────────────
-# Core map drawing
+# Helper: basemap tile fetching
 # ─────────────────────────────
-def plot_stylish_map(country_gdf, rivers_gdf, country_name, stem_name):
-    print("Reprojecting to Web Mercator...")
-    country_3857 = country_gdf.to_crs(epsg=3857)
-    rivers_3857 = rivers_gdf.to_crs(epsg=3857)
+# The tile fetch is a network round-trip and independent of the river
+# plotting, so it runs on this executor while the main thread draws.
+_BASEMAP_EXECUTOR = ThreadPoolExecutor(max_workers=2)
 
-    print("Preparing figure...")
-    fig, ax = plt.subplots(1, 1, figsize=(12, 12), dpi=150)
-    country_3857.plot(ax=ax, color="#f3efe0", edgecolor="#444444", linewidth=0.8)
 
-    print("Computing river size metric...")
-    if "UPLAND_SKM" in rivers_3857.columns:
-        metric = rivers_3857["UPLAND_SKM"].fillna(0).astype(float)
-    else:
-        metric = rivers_3857.geometry.length
+def fetch_basemap(minx, miny, maxx, maxy, zoom, stem):
+    """Fetch the basemap mosaic for a Web Mercator bbox, with a disk cache.
 
-    if metric.max() > 0:
-        rel = metric / metric.max()
+    The cache is keyed by (country stem, zoom) since the bbox is a pure
+    function of the country. Returns (image_array, extent) or (None, None)
+    if every provider failed.
+    """
+    key = f"basemap_{stem}_z{zoom}"
+    img_fp = os.path.join(DATA_FOLDER, key + ".npy")
+    ext_fp = os.path.join(DATA_FOLDER, key + ".json")
+
+    if os.path.exists(img_fp) and os.path.exists(ext_fp):
+        try:
+            with open(ext_fp) as f:
+                ext = tuple(json.load(f))
+            # mmap keeps the reload effectively free; pixels are paged in
+            # only as imshow touches them.
+            return np.load(img_fp, mmap_mode="r"), ext
+        except Exception as e:
+            # Corrupt/truncated cache entry: warn and refetch.
+            print("Warning: could not read cached basemap:", e)
+
+    # Resolve the provider attributes inside the guarded loop: xyzservices
+    # releases that dropped the dead Stamen tiles raise AttributeError on
+    # mere attribute access, and that should degrade to "no basemap" just
+    # like a failed fetch.
+    for provider in ("Stamen.TerrainBackground", "OpenStreetMap.Mapnik"):
+        try:
+            source = ctx.providers
+            for part in provider.split("."):
+                source = getattr(source, part)
+            img, ext = ctx.bounds2img(minx, miny, maxx, maxy, zoom=zoom, source=source, ll=False)
+            break
+        except Exception as e:
+            print("Warning: basemap fetch failed:", e)
     else:
-        rel = metric
-
-    cats = pd.cut(rel, bins=[-1, 0.33, 0.66, 1.0],
-                  labels=["small", "medium", "large"])
-    rivers_3857 = rivers_3857.assign(_size_cat=cats)
-
-    print("Plotting rivers by size classes...")
-    class_styles = {
-        "small": {"linewidth": 0.8, "alpha": 0.8},
-        "medium": {"linewidth": 1.8, "alpha": 0.9},
-        "large": {"linewidth": 4.0, "alpha": 0.95},
-    }
-    for cat, style in class_styles.items():
-        subset = rivers_3857[rivers_3857["_size_cat"] == cat]
-        if len(subset):
-            subset.plot(
-                ax=ax,
-                color="#1f78b4",
-                linewidth=style["linewidth"],
-                alpha=style["alpha"],
-            )
+        return None, None
+
+    try:
+        # Write via temp files + os.replace so a concurrent request for the
+        # same country never sees a half-written cache entry.
+        tmp_img_fp = img_fp + ".tmp"
+        with open(tmp_img_fp, "wb") as f:
+            np.save(f, img)
+        os.replace(tmp_img_fp, img_fp)
+
+        tmp_ext_fp = ext_fp + ".tmp"
+        with open(tmp_ext_fp, "w") as f:
+            json.dump(list(ext), f)
+        os.replace(tmp_ext_fp, ext_fp)
+    except Exception as e:
+        print("Warning: could not cache basemap:", e)
+
+    return img, ext
+
+# ─────────────────────────────
+# Helper: ragged coords -> line segments
+# ─────────────────────────────
+# `shapely.to_ragged_array` gives a flat (N, 2) coordinate buffer plus
+# per-line offsets. LineCollection also accepts a compact (n_segs, 2, 2)
+# array, which we can fill in one pass (and one allocation) instead of
+# np.split's M small ndarrays.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True)
+    def build_segments(coords, offsets):
+        total = 0
+        for i in range(len(offsets) - 1):
+            total += offsets[i + 1] - offsets[i] - 1
+        segs = np.empty((total, 2, 2), dtype=np.float32)
+        k = 0
+        for i in range(len(offsets) - 1):
+            s, e = offsets[i], offsets[i + 1]
+            for j in range(s, e - 1):
+                segs[k, 0, 0] = coords[j, 0]
+                segs[k, 0, 1] = coords[j, 1]
+                segs[k, 1, 0] = coords[j + 1, 0]
+                segs[k, 1, 1] = coords[j + 1, 1]
+                k += 1
+        return segs
+else:
+    def build_segments(coords, offsets):
+        # Vectorized NumPy fallback: pair consecutive coords, dropping the
+        # pairs that would bridge two different lines.
+        keep = np.ones(len(coords) - 1, dtype=bool)
+        keep[offsets[1:-1] - 1] = False
+        segs = np.empty((int(keep.sum()), 2, 2), dtype=np.float32)
+        segs[:, 0, :] = coords[:-1][keep]
+        segs[:, 1, :] = coords[1:][keep]
+        return segs
+
+# ─────────────────────────────
+# Helper: figure pool
+# ─────────────────────────────
+# A 12x12 in / 150 dpi figure is a large allocation plus dozens of artists;
+# reuse figures across requests instead of rebuilding them each time. Agg is
+# thread-safe per figure as long as savefig itself is serialized.
+_FIG_POOL = queue.Queue()
+_FIG_LOCK = threading.Lock()
+
+
+def get_fig():
+    try:
+        fig = _FIG_POOL.get_nowait()
+    except queue.Empty:
+        # Build the figure directly rather than via pyplot: Gcf (pyplot's
+        # global figure registry) is not thread-safe under Flask's threaded
+        # server, and pooled figures would stay registered there forever.
+        # Agg needs no pyplot manager to savefig.
+        fig = Figure(figsize=(12, 12), dpi=150)
+        fig.subplots()
+    return fig, fig.axes[0]
+
+
+def release_fig(fig):
+    for ax in fig.axes:
+        ax.clear()
+    _FIG_POOL.put(fig)
+
+# ─────────────────────────────
+# Core map drawing
+# ─────────────────────────────
+def plot_stylish_map(country_gdf, river_idx, country_name, stem_name):
+    fig, ax = get_fig()
+    try:
+        return _plot_stylish_map(fig, ax, country_gdf, river_idx, country_name, stem_name)
+    finally:
+        release_fig(fig)
+
+
+def _plot_stylish_map(fig, ax, country_gdf, river_idx, country_name, stem_name):
+    print("Reprojecting to Web Mercator...")
+    country_3857 = country_gdf.to_crs(epsg=3857)
+    rivers_3857 = _RIVERS_3857.iloc[river_idx]
 
     minx, miny, maxx, maxy = country_3857.total_bounds
     xbuffer = (maxx - minx) * 0.03 if (maxx - minx) > 0 else 10000
     ybuffer = (maxy - miny) * 0.03 if (maxy - miny) > 0 else 10000
-    ax.set_xlim(minx - xbuffer, maxx + xbuffer)
-    ax.set_ylim(miny - ybuffer, maxy + ybuffer)
 
-    print("Adding basemap...")
     width_m = maxx - minx
     if width_m <= 0:
         zoom = 6
@@ -196,14 +373,69 @@ def plot_stylish_map(country_gdf, rivers_gdf, country_name, stem_name):
     else:
         zoom = 10
 
+    # Kick off the tile fetch now; it overlaps with the plotting below.
+    print("Fetching basemap in background...")
+    basemap_future = _BASEMAP_EXECUTOR.submit(
+        fetch_basemap, minx - xbuffer, miny - ybuffer, maxx + xbuffer, maxy + ybuffer, zoom,
+        stem_name,
+    )
+
+    print("Preparing figure...")
+    # Laying out up front means savefig renders once; bbox_inches='tight'
+    # would render a throwaway pass just to measure the bounding box.
+    fig.set_layout_engine('tight')
+    country_3857.plot(ax=ax, color="#f3efe0", edgecolor="#444444", linewidth=0.8)
+
+    print("Computing river size metric...")
+    metric = _UPLAND[river_idx]
+
+    m = metric.max() if metric.size else np.float32(0.0)
+    rel = metric * (np.float32(1.0) / m) if m > 0 else metric
+
+    # Class indices 0/1/2 = small (<0.33), medium (0.33-0.66), large (>0.66).
+    # np.digitize on a NumPy array avoids the pandas Categorical that pd.cut
+    # builds, plus the GeoDataFrame copy that .assign would make.
+    cat_idx = np.digitize(rel, np.array([0.33, 0.66], dtype=np.float32)).astype(np.uint8)
+
+    print("Plotting rivers...")
+    if len(rivers_3857):
+        # One LineCollection over all rivers with per-segment widths and
+        # RGBA colors: a single vertex upload and draw pass instead of one
+        # per size class.
+        _, coords, (offsets,) = shapely.to_ragged_array(rivers_3857.geometry.values)
+        segments = build_segments(coords, offsets)
+
+        # Expand the per-river class to per-segment styling (each river with
+        # n vertices contributes n-1 segments).
+        seg_cat = np.repeat(cat_idx, np.diff(offsets) - 1)
+        widths = np.choose(seg_cat, [0.8, 1.8, 4.0]).astype(np.float32)
+        alphas = np.choose(seg_cat, [0.8, 0.9, 0.95]).astype(np.float32)
+        colors = np.tile(np.array([0.122, 0.471, 0.706, 1.0], dtype=np.float32),
+                         (len(segments), 1))
+        colors[:, 3] = alphas
+
+        # rasterized=True makes the vector-PDF fallback path rasterize just
+        # the rivers layer via Agg instead of re-drawing every vertex, while
+        # titles and the legend stay vector.
+        lc = LineCollection(segments, linewidths=widths, colors=colors,
+                            rasterized=True)
+        ax.add_collection(lc)
+
+    print("Adding basemap...")
     try:
-        ctx.add_basemap(ax, source=ctx.providers.Stamen.TerrainBackground, zoom=zoom)
+        img, ext = basemap_future.result()
     except Exception as e:
+        # The map is still useful without tiles; never fail the request on
+        # a basemap problem.
         print("Warning: basemap failed:", e)
-        try:
-            ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, zoom=zoom)
-        except Exception as e2:
-            print("Warning: fallback basemap failed:", e2)
+        img, ext = None, None
+    if img is not None:
+        ax.imshow(img, extent=ext, interpolation="bilinear", zorder=-1)
+    else:
+        print("Warning: no basemap available")
+
+    ax.set_xlim(minx - xbuffer, maxx + xbuffer)
+    ax.set_ylim(miny - ybuffer, maxy + ybuffer)
 
     ax.set_title(f"Rivers of {country_name}", fontsize=18, fontweight="bold")
     ax.axis("off")
@@ -225,61 +457,96 @@ def plot_stylish_map(country_gdf, rivers_gdf, country_name, stem_name):
     pdf_path = os.path.join(OUTPUT_FOLDER, pdf_name)
 
     print("Saving PNG:", png_path)
-    fig.savefig(png_path, bbox_inches='tight', dpi=200)
+    with _FIG_LOCK:
+        fig.savefig(png_path, dpi=200)
 
+    # Wrap the already-rendered PNG in a one-page PDF instead of making
+    # matplotlib's PDF backend re-draw every river vertex. Agg writes RGBA
+    # PNGs, so flatten to RGB for the PDF embedding.
     print("Saving PDF:", pdf_path)
-    fig.savefig(pdf_path, bbox_inches='tight')
+    try:
+        from PIL import Image
+    except ImportError:
+        print("Warning: Pillow not available, re-rendering PDF via matplotlib")
+        with _FIG_LOCK:
+            fig.savefig(pdf_path)
+    else:
+        Image.open(png_path).convert("RGB").save(pdf_path)
 
-    plt.close(fig)
     return png_name, pdf_name
 
 def generate_country_map(country_name: str):
-    hydro_url = DATA_URL + "hydrosheds/" + HYDRORIVERS_FILE
-    countries_url = DATA_URL + "naturalearth/" + COUNTRIES_FILE
-
-    countries_fp = download_and_save(countries_url, COUNTRIES_FILE)
-    hydrorivers_fp = download_and_save(hydro_url, HYDRORIVERS_FILE)
-
-    country_gdf = gpd.read_file(countries_fp)
-    country_input = country_name.strip()
-
-    selected_country = country_gdf[
-        (country_gdf["SOVEREIGNT"].str.lower() == country_input.lower())
-        & (country_gdf["TYPE"] != "Dependency")
-    ]
+    stem = f"rivers_of_{country_name.lower().replace(' ', '_')}"
+    png_name = f"{stem}.png"
+    pdf_name = f"{stem}.pdf"
+
+    # Outputs are deterministic per country: if both files already exist we
+    # can skip the whole read/filter/render pipeline.
+    if os.path.exists(os.path.join(OUTPUT_FOLDER, png_name)) and os.path.exists(
+        os.path.join(OUTPUT_FOLDER, pdf_name)
+    ):
+        print("Using cached map for", country_name)
+        return png_name, pdf_name
+
+    # The mainland (largest-polygon) mask only depends on the country, so we
+    # cache it as GeoParquet next to the source data after the first request.
+    mainland_fp = os.path.join(DATA_FOLDER, f"mainland_{stem}.parquet")
+    if os.path.exists(mainland_fp):
+        print("Loading cached mainland mask:", mainland_fp)
+        mainland_gdf = gpd.read_parquet(mainland_fp)
+    else:
+        key = country_name.strip().lower()
 
-    if selected_country.empty:
-        mask = country_gdf["SOVEREIGNT"].str.lower().str.contains(country_input.lower())
-        selected_country = country_gdf[mask & (country_gdf["TYPE"] != "Dependency")]
-
-    if selected_country.empty:
-        raise ValueError(f"Country '{country_name}' not found. Try a different name.")
-
-    selected_3857 = selected_country.to_crs(epsg=3857)
-    parts = []
-    for geom in selected_3857.geometry:
-        if geom is None:
-            continue
-        if geom.geom_type in ["MultiPolygon", "GeometryCollection"]:
-            for part in geom.geoms:
-                parts.append(part)
+        if key in _COUNTRY_EXACT:
+            selected_country = _COUNTRY_NON_DEP.iloc[_COUNTRY_EXACT[key]]
         else:
-            parts.append(geom)
+            mask = np.char.find(_SOV_LOWER_NP, key) >= 0
+            selected_country = _COUNTRY_NON_DEP[mask]
+
+        if selected_country.empty:
+            raise ValueError(f"Country '{country_name}' not found. Try a different name.")
+
+        selected_3857 = selected_country.to_crs(epsg=3857)
+        # Flatten multi-part geometries and measure them in single vectorized
+        # GEOS calls instead of looping part-by-part in Python; countries like
+        # Indonesia or Canada have thousands of islands.
+        parts = shapely.get_parts(selected_3857.geometry.values)
+
+        if len(parts) == 0:
+            # shapely.union_all runs GEOSUnaryUnion over the whole array in
+            # one C call, unlike the per-geometry cascade of unary_union.
+            mainland_mask = shapely.union_all(selected_country.geometry.values)
+            mainland_gdf = gpd.GeoDataFrame(geometry=[mainland_mask], crs=selected_country.crs)
+        else:
+            areas = shapely.area(parts)
+            largest = parts[int(areas.argmax())]
+            # Transform the single polygon directly rather than routing it
+            # through a one-element GeoSeries and .to_crs.
+            tr = get_transformer(3857, selected_country.crs).transform
+            mainland_mask = geom_transform(tr, largest)
+            mainland_gdf = gpd.GeoDataFrame(geometry=[mainland_mask], crs=selected_country.crs)
 
-    if len(parts) == 0:
-        mainland_mask = selected_country.geometry.unary_union
-        mainland_gdf = selected_country
-    else:
-        areas = [g.area for g in parts]
-        largest_idx = int(np.argmax(areas))
-        largest = parts[largest_idx]
-        mainland_3857 = gpd.GeoSeries([largest], crs=3857)
-        mainland_mask = mainland_3857.to_crs(selected_country.crs).geometry.iloc[0]
-        mainland_gdf = gpd.GeoDataFrame(geometry=[mainland_mask], crs=selected_country.crs)
-
-    river_gdf = gpd.read_file(hydrorivers_fp, mask=mainland_mask)
-    stem = f"rivers_of_{country_name.lower().replace(' ', '_')}"
-    return plot_stylish_map(mainland_gdf, river_gdf, country_name, stem)
+        try:
+            mainland_gdf.to_parquet(mainland_fp)
+        except Exception as e:
+            print("Warning: could not cache mainland mask:", e)
+
+    # Reproject the single mainland polygon to match the tree's CRS; far
+    # cheaper than reprojecting every intersecting river afterwards.
+    mainland_3857_geom = mainland_gdf.to_crs(epsg=3857).geometry.iloc[0]
+    # GEOS `intersects` scales with polygon vertex count; a 1 km simplify
+    # drops vertices 10-100x without changing which rivers are picked up.
+    query_geom = shapely.simplify(mainland_3857_geom, tolerance=1000, preserve_topology=False)
+    # A 1 km non-topology-preserving simplify can collapse tiny countries
+    # (Monaco, Vatican) to an empty or invalid geometry; fall back to the
+    # full polygon rather than silently selecting zero rivers.
+    if query_geom is None or query_geom.is_empty or not query_geom.is_valid:
+        query_geom = mainland_3857_geom
+    # Preparing the polygon builds a GEOS edge index, so each candidate's
+    # intersects test is logarithmic in the vertex count instead of linear.
+    shapely.prepare(query_geom)
+    idx = _RIVERS_TREE.query(query_geom, predicate="intersects")
+    return plot_stylish_map(mainland_gdf, idx, country_name, stem)
 
 # ─────────────────────────────
 # Flask app